@@ -1,54 +1,133 @@
+from __future__ import annotations
+
 import os
-import akshare as ak
-import requests
+import re
+import ast
+import time
+import asyncio
+import builtins
+import hashlib
+import sqlite3
+import threading
+import importlib
+import importlib.util
+import httpx
+import orjson
 import datetime
-import pandas as pd
+from cachetools import TLRUCache
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional, Tuple
-from rich.console import Console
+from functools import lru_cache
+from typing import AsyncGenerator, Dict, Any, Callable, Final, List, Optional, Tuple
+from rich.console import Console, Group
 from rich.panel import Panel
+from rich.live import Live
 from rich.table import Table
 from rich.markdown import Markdown
+from rich.text import Text
 from rich import box
 
+
+class _LazyModule:
+    """延迟导入的模块代理，首次访问属性时才真正导入模块"""
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr: str) -> Any:
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# akshare、pandas、numpy导入较慢，只有执行数据查询时才需要
+ak = _LazyModule("akshare")
+pd = _LazyModule("pandas")
+np = _LazyModule("numpy")
+
+# 语义缓存依赖为可选项，未安装时仅使用精确匹配缓存
+SEMANTIC_CACHE_AVAILABLE = all(
+    importlib.util.find_spec(name) is not None for name in ("faiss", "sentence_transformers")
+)
+
 # 加载环境变量
 load_dotenv()
 
-# 创建全局console对象
-console = Console()
+# 创建全局console对象（输出均使用显式标记样式，关闭自动高亮）
+console = Console(highlight=False)
 
-class NLDataQuery:
-    def __init__(self, debug_mode: bool = False):
-        """初始化自然语言数据查询工具
-        
-        Args:
-            debug_mode: 是否显示生成的代码（默认False）
-        """
-        self.deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
-        self.deepseek_api_url = "https://api.deepseek.com/v1/chat/completions"
-        self.debug_mode = debug_mode
-        self.last_result = None  # 保存最后一次查询结果
-        self.last_query = None   # 保存最后一次查询语句
-        
-        if not self.deepseek_api_key:
-            raise ValueError("请设置DEEPSEEK_API_KEY环境变量")
+# 欢迎界面和提示信息只构建一次
+EXAMPLES = [
+    "获取上证指数最近10天的数据",
+    "查询贵州茅台的最新股价",
+    "什么是市盈率？",
+    "获取国内成品油价格调整信息"
+]
+WELCOME = Group(
+    Panel.fit(
+        "[bold cyan]金融数据智能查询助手[/bold cyan]\n"
+        "[dim]基于 AKShare 和 DeepSeek AI[/dim]",
+        border_style="cyan"
+    ),
+    Text.from_markup(
+        "\n[bold]使用说明:[/bold]\n"
+        "• 您可以用自然语言查询金融数据\n"
+        "• 也可以提出问题寻求解释和建议\n"
+        "• 输入 [yellow]'save'[/yellow] 保存最后一次的查询数据\n"
+        "• 输入 [yellow]'exit'[/yellow] 或 [yellow]'quit'[/yellow] 退出程序\n"
+        "• 输入 [yellow]'debug'[/yellow] 切换调试模式\n\n"
+        "[bold]示例查询:[/bold]\n"
+        + "\n".join(f"  {i}. [cyan]{example}[/cyan]" for i, example in enumerate(EXAMPLES, 1))
+        + "\n"
+    )
+)
+SAVE_HINT = Text("输入 'save' 命令可保存此次查询结果", style="dim")
 
-    def call_deepseek(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
-        """调用DeepSeek API解析自然语言查询
-        
-        Returns:
-            Tuple[query_type, content]: 查询类型和内容
-            - query_type: "code" (数据查询) 或 "explain" (解释说明) 或 None
-            - content: 生成的代码或解释文本
-        """
-        try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.deepseek_api_key}"
-            }
-            
-            # 改进的提示词，能够识别问题类型
-            system_prompt = """
+# DeepSeek模型参数
+DEEPSEEK_MODEL = "deepseek-chat"
+DEEPSEEK_TEMPERATURE = 0.3
+# 限制回复长度：代码回复只有一行（收到换行即停止读取），上限主要约束解释类回答
+DEEPSEEK_MAX_TOKENS = 1024
+# 回答因达到长度上限被截断时附加的提示
+TRUNCATED_NOTE = "\n\n（回答过长，已截断）"
+
+# DeepSeek请求并发数与重试策略
+DEEPSEEK_CONCURRENCY = 3
+DEEPSEEK_RETRIES = 2
+DEEPSEEK_RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+# 安装了h2时启用HTTP/2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# 查询结果缓存（SQLite持久化，过期时间24小时）
+CACHE_DB_PATH = "deepseek_cache.db"
+CACHE_TTL = 24 * 60 * 60
+CACHE_SIZE = 1024
+
+# 语义缓存：相似度达到阈值的查询视为同一问题
+# 只用于解释类回答：数据查询的代码带有股票代码、天数、日期等参数，相似的问法可能需要不同的代码
+SEMANTIC_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+SEMANTIC_THRESHOLD = 0.85
+# 含有这些词或数字的查询按数据查询处理，不查找语义缓存，避免命中措辞相近的解释类回答
+DATA_QUERY_KEYWORDS = ("查询", "获取", "最新", "最近", "今天", "今日", "实时", "行情", "数据",
+                       "走势", "股价", "价格", "收盘", "开盘", "涨跌", "成交")
+
+# 数据缓存有效期（秒）：日线等历史数据1小时，其余5分钟；实时行情和分时数据不缓存
+DATA_CACHE_SIZE = 128
+DATA_TTL_DAILY = 3600
+DATA_TTL_DEFAULT = 300
+REALTIME_KEYWORDS = ("spot", "realtime", "latest", "_min", "minute", "tick")
+DAILY_KEYWORDS = ("daily", "hist")
+
+# DataFrame保存格式，默认使用Parquet（列式压缩存储，保留数据类型）
+DATAFRAME_FORMATS = (".parquet", ".csv", ".feather")
+
+# 文件名中需要去除的字符：只保留中英文、数字和 "._- "
+FILENAME_STRIP = re.compile(r"[^\w.\- ]")
+
+# 改进的提示词，能够识别问题类型
+# 每次请求都发送完全相同的系统消息，使DeepSeek服务端的前缀缓存（context caching）能够命中
+SYSTEM_PROMPT: Final[str] = """
 你是一个智能金融数据查询助手。你需要分析用户的输入并做出判断：
 
 【判断规则】
@@ -62,19 +141,13 @@ class NLDataQuery:
 - 只返回可执行的Python单行表达式
 - 使用akshare库（已导入为ak）获取数据
 - 不要包含print语句
-- 不要导入任何库(已导入库如下：
-import os
+- 不要导入任何库(只能使用以下已导入的库：
 import akshare as ak
-import requests
-import datetime
 import pandas as pd
-from dotenv import load_dotenv
-from typing import Dict, Any, Optional, Tuple
-from rich.console import Console
-from rich.panel import Panel
-from rich.table import Table
-from rich.markdown import Markdown
-from rich import box)
+import datetime)
+- 只能调用ak的函数及其返回结果的方法，可以使用常用内置函数（如len、zip、sorted、round），
+  以及datetime.date.today()、datetime.timedelta()、pd.concat()、pd.to_datetime()等辅助函数；
+  不要访问模块的其他属性，不要读写文件
 - 代码应返回pandas DataFrame或基本数据类型
 
 【示例】
@@ -87,57 +160,583 @@ from rich import box)
 用户："帮我分析一下今天的股市"
 返回：EXPLAIN|我可以帮您获取实时的股市数据。您想了解哪些具体指数或股票的信息？比如上证指数、深证成指、创业板指等。
 """
-            
+SYSTEM_MESSAGE: Final[Dict[str, str]] = {"role": "system", "content": SYSTEM_PROMPT}
+# 系统提示词部分的哈希只计算一次，生成缓存键时复制后再追加其余内容
+SYSTEM_PROMPT_HASH: Final = hashlib.sha256((SYSTEM_PROMPT + "\x1f").encode("utf-8"))
+
+# 生成代码中的模块名，只能以 ak.<函数>(...) 或下面的辅助函数调用形式出现
+CODE_NAMES = frozenset(["ak", "pd", "datetime"])
+HELPER_CALLS = frozenset([
+    ("datetime", "date"),
+    ("datetime", "date", "today"),
+    ("datetime", "datetime"),
+    ("datetime", "datetime", "now"),
+    ("datetime", "datetime", "strptime"),
+    ("datetime", "timedelta"),
+    ("pd", "concat"),
+    ("pd", "merge"),
+    ("pd", "DataFrame"),
+    ("pd", "Series"),
+    ("pd", "to_datetime"),
+    ("pd", "to_numeric"),
+    ("pd", "Timestamp"),
+    ("pd", "Timedelta")
+])
+# 生成代码可以使用的内置函数
+SAFE_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in ("abs", "all", "any", "bool", "dict", "enumerate", "filter", "float",
+                 "int", "isinstance", "len", "list", "map", "max", "min", "range",
+                 "reversed", "round", "set", "sorted", "str", "sum", "tuple", "zip")
+}
+# datetime.date.today()等内部实现需要导入模块；生成的代码本身不能引用双下划线名称
+SAFE_BUILTINS["__import__"] = builtins.__import__
+# 查询结果上禁止访问的属性（写文件、执行字符串表达式、格式化字段访问属性、绘图等），
+# to_开头的方法只允许不接受文件路径的纯转换
+BLOCKED_ATTRS = frozenset(["eval", "query", "tofile", "dump", "dumps", "ctypes",
+                           "format", "format_map", "plot", "hist", "boxplot", "style"])
+ALLOWED_TO_METHODS = frozenset(["to_list", "to_dict", "to_numpy", "to_frame",
+                                "to_records", "to_period", "to_timestamp", "to_pydatetime"])
+# 语法树中允许出现的其他节点类型，子节点仍需逐一校验
+SAFE_NODES = (
+    ast.Expression, ast.Constant, ast.List, ast.Tuple, ast.Set, ast.Dict,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Subscript,
+    ast.Slice, ast.JoinedStr, ast.FormattedValue, ast.Starred,
+    ast.operator, ast.unaryop, ast.cmpop, ast.boolop, ast.expr_context
+)
+
+def _is_realtime(code: str) -> bool:
+    """代码是否获取实时行情（此类数据不缓存）"""
+    return any(keyword in code for keyword in REALTIME_KEYWORDS)
+
+
+def _is_data_query(prompt: str) -> bool:
+    """查询是否可能需要获取数据（此类查询不使用语义缓存）"""
+    return (any(keyword in prompt for keyword in DATA_QUERY_KEYWORDS)
+            or any(char.isdigit() for char in prompt))
+
+
+def _reply_ttu(key: str, value: Tuple[str, str, int], now: float) -> float:
+    """回复缓存条目的过期时间：写入时间加上CACHE_TTL"""
+    return value[2] + CACHE_TTL
+
+
+def _data_ttu(key: Tuple[str, str], result: Any, now: float) -> float:
+    """根据代码调用的接口类型确定数据缓存的过期时间"""
+    code = key[0]
+    if any(keyword in code for keyword in DAILY_KEYWORDS):
+        return now + DATA_TTL_DAILY
+    return now + DATA_TTL_DEFAULT
+
+
+def _dotted_name(node: ast.AST) -> Optional[Tuple[str, ...]]:
+    """将 a.b.c 形式的属性链转换为 ("a", "b", "c")，其他表达式返回None"""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return tuple(reversed(parts))
+
+
+def _is_blocked_attr(name: str) -> bool:
+    """是否为查询结果上禁止访问的属性"""
+    return (name.startswith("_") or name in BLOCKED_ATTRS
+            or (name.startswith("to_") and name not in ALLOWED_TO_METHODS))
+
+
+def _bind_names(target: ast.AST) -> set:
+    """推导式中绑定的变量名"""
+    if isinstance(target, ast.Name):
+        names = {target.id}
+    elif isinstance(target, (ast.Tuple, ast.List)):
+        names = set().union(*(_bind_names(elt) for elt in target.elts))
+    else:
+        raise ValueError(f"不允许的语法 {type(target).__name__}")
+    if names & CODE_NAMES:
+        raise ValueError(f"不允许重新绑定 {', '.join(sorted(names & CODE_NAMES))}")
+    return names
+
+
+def _check_node(node: ast.AST, bound: set) -> None:
+    """按白名单校验生成代码的语法树，不符合时抛出ValueError
+    
+    模块对象只能以 ak.<公开函数>(...) 或 HELPER_CALLS 中的调用形式出现，
+    其余部分只能是对调用结果的方法调用、下标、运算、字面量和lambda/推导式。
+    """
+    if isinstance(node, ast.Call):
+        path = _dotted_name(node.func)
+        if path is not None and path[0] in CODE_NAMES:
+            is_ak_call = len(path) == 2 and path[0] == "ak" and not path[1].startswith("_")
+            if not is_ak_call and path not in HELPER_CALLS:
+                raise ValueError(f"不允许调用 {'.'.join(path)}")
+        elif isinstance(node.func, ast.Name):
+            if node.func.id.startswith("__") or node.func.id not in SAFE_BUILTINS:
+                raise ValueError(f"不允许调用 {node.func.id}")
+        else:
+            _check_node(node.func, bound)
+        for arg in node.args:
+            _check_node(arg, bound)
+        for keyword in node.keywords:
+            _check_node(keyword.value, bound)
+        return
+    
+    if isinstance(node, ast.Attribute):
+        path = _dotted_name(node)
+        if path is not None and path[0] in CODE_NAMES:
+            raise ValueError(f"不允许访问模块属性 {'.'.join(path)}")
+        if _is_blocked_attr(node.attr):
+            raise ValueError(f"不允许访问属性 {node.attr}")
+        _check_node(node.value, bound)
+        return
+    
+    if isinstance(node, ast.Name):
+        if node.id in bound or (node.id in SAFE_BUILTINS and not node.id.startswith("__")):
+            return
+        raise ValueError(f"不允许使用名称 {node.id}")
+    
+    if isinstance(node, ast.Constant):
+        # 防止通过 apply("to_pickle", ...) 等按名称调用被禁止的方法
+        if isinstance(node.value, str) and _is_blocked_attr(node.value):
+            raise ValueError(f"不允许使用字符串 {node.value!r}")
+        return
+    
+    if isinstance(node, ast.Lambda):
+        args = node.args
+        params = [*args.posonlyargs, *args.args, *args.kwonlyargs, args.vararg, args.kwarg]
+        names = {param.arg for param in params if param is not None}
+        if names & CODE_NAMES:
+            raise ValueError(f"不允许重新绑定 {', '.join(sorted(names & CODE_NAMES))}")
+        for default in [*args.defaults, *args.kw_defaults]:
+            if default is not None:
+                _check_node(default, bound)
+        _check_node(node.body, bound | names)
+        return
+    
+    if isinstance(node, (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)):
+        inner = set(bound)
+        for generator in node.generators:
+            if generator.is_async:
+                raise ValueError("不允许的语法 async")
+            _check_node(generator.iter, inner)
+            inner |= _bind_names(generator.target)
+            for condition in generator.ifs:
+                _check_node(condition, inner)
+        elements = [node.key, node.value] if isinstance(node, ast.DictComp) else [node.elt]
+        for element in elements:
+            _check_node(element, inner)
+        return
+    
+    if isinstance(node, SAFE_NODES):
+        for child in ast.iter_child_nodes(node):
+            _check_node(child, bound)
+        return
+    
+    raise ValueError(f"不允许的语法 {type(node).__name__}")
+
+
+@lru_cache(maxsize=256)
+def _compile_code(code: str):
+    """校验并编译生成的单行表达式，相同代码只编译一次"""
+    tree = ast.parse(code, mode="eval")
+    _check_node(tree, set())
+    return compile(tree, "<deepseek>", "eval")
+
+class NLDataQuery:
+    def __init__(self, debug_mode: bool = False):
+        """初始化自然语言数据查询工具
+        
+        Args:
+            debug_mode: 是否显示生成的代码（默认False）
+        """
+        self.deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
+        self.deepseek_api_url = "https://api.deepseek.com/v1/chat/completions"
+        self.debug_mode = debug_mode
+        self.last_result = None  # 保存最后一次查询结果
+        self.last_query = None   # 保存最后一次查询语句
+        self._data_dir = os.path.abspath("data")  # 查询结果保存目录
+        
+        if not self.deepseek_api_key:
+            raise ValueError("请设置DEEPSEEK_API_KEY环境变量")
+        
+        # HTTP客户端和限制并发请求数的信号量都绑定在事件循环上，由_http()按当前事件循环创建
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._client_owner: Optional[AsyncGenerator[None, None]] = None
+        # 正在请求中的查询，相同查询共享同一个结果
+        self._inflight: Dict[str, asyncio.Future] = {}
+        
+        # 相同代码在有效期内直接返回上次获取的数据；execute_code在线程中运行，需要加锁
+        self._data_cache = TLRUCache(maxsize=DATA_CACHE_SIZE, ttu=_data_ttu)
+        self._data_lock = threading.Lock()
+        
+        # 相同查询直接复用已解析的结果，避免重复调用API；条目为(类型, 内容, 写入时间)
+        self._cache = TLRUCache(maxsize=CACHE_SIZE, ttu=_reply_ttu, timer=time.time)
+        self._cache_db = self._open_cache_db()
+        
+        # 语义缓存：换一种说法的相同问题也能命中；向量模型加载较慢，首次查找时才初始化
+        self._embed = None
+        self._index = None
+        self._entries: List[Tuple[str, str]] = []
+        self._semantic_loaded = not SEMANTIC_CACHE_AVAILABLE
+
+    def _open_cache_db(self) -> Optional[sqlite3.Connection]:
+        """打开持久化缓存数据库，失败时仅使用内存缓存"""
+        try:
+            conn = sqlite3.connect(CACHE_DB_PATH)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deepseek_cache ("
+                "key TEXT PRIMARY KEY, qtype TEXT, content TEXT, ts INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache ("
+                "prompt TEXT PRIMARY KEY, embedding BLOB, qtype TEXT, content TEXT, ts INTEGER)"
+            )
+            expire = int(time.time()) - CACHE_TTL
+            conn.execute("DELETE FROM deepseek_cache WHERE ts < ?", (expire,))
+            conn.execute("DELETE FROM semantic_cache WHERE ts < ?", (expire,))
+            conn.commit()
+            return conn
+        except sqlite3.Error as e:
+            console.print(f"[yellow]⚠ 缓存数据库不可用: {str(e)}[/yellow]")
+            return None
+
+    def _init_semantic_cache(self) -> None:
+        """加载向量模型并从持久化缓存重建索引"""
+        self._semantic_loaded = True
+        try:
+            import faiss
+            from sentence_transformers import SentenceTransformer
+            self._embed = SentenceTransformer(SEMANTIC_MODEL)
+            self._index = faiss.IndexFlatIP(self._embed.get_sentence_embedding_dimension())
+        except Exception as e:
+            console.print(f"[yellow]⚠ 语义缓存不可用: {str(e)}[/yellow]")
+            self._embed = None
+            self._index = None
+            return
+        
+        if self._cache_db is None:
+            return
+        rows = self._cache_db.execute(
+            "SELECT embedding, qtype, content FROM semantic_cache WHERE qtype = 'explain' ORDER BY ts"
+        ).fetchall()
+        for embedding, query_type, content in rows:
+            self._index.add(np.frombuffer(embedding, dtype=np.float32).reshape(1, -1))
+            self._entries.append((query_type, content))
+
+    def _semantic_get(self, prompt: str) -> Tuple[Optional[Tuple[str, str]], Any]:
+        """查找语义相近的已缓存查询
+        
+        Returns:
+            Tuple[cached, vector]: 命中的缓存结果（未命中为None）和查询向量
+        """
+        if _is_data_query(prompt):
+            return None, None
+        if not self._semantic_loaded:
+            self._init_semantic_cache()
+        if self._embed is None:
+            return None, None
+        vector = self._embed.encode([prompt], normalize_embeddings=True).astype(np.float32)
+        if self._index.ntotal > 0:
+            scores, ids = self._index.search(vector, 1)
+            if scores[0][0] >= SEMANTIC_THRESHOLD:
+                return self._entries[ids[0][0]], vector
+        return None, vector
+
+    def _semantic_put(self, prompt: str, vector: Any, query_type: str, content: str) -> None:
+        """将解释类回答的查询向量加入索引并持久化"""
+        if self._index is None or vector is None or query_type != "explain":
+            return
+        self._index.add(vector)
+        self._entries.append((query_type, content))
+        if self._cache_db is None:
+            return
+        try:
+            self._cache_db.execute(
+                "INSERT OR REPLACE INTO semantic_cache (prompt, embedding, qtype, content, ts) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (prompt, vector.tobytes(), query_type, content, int(time.time()))
+            )
+            self._cache_db.commit()
+        except sqlite3.Error:
+            pass
+
+    @staticmethod
+    def _cache_key(prompt: str) -> str:
+        """根据提示词和模型参数生成缓存键"""
+        digest = SYSTEM_PROMPT_HASH.copy()
+        digest.update("\x1f".join((prompt, DEEPSEEK_MODEL, str(DEEPSEEK_TEMPERATURE))).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _cache_get(self, key: str) -> Optional[Tuple[str, str]]:
+        """依次查找内存缓存和持久化缓存"""
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached[0], cached[1]
+        if self._cache_db is None:
+            return None
+        try:
+            row = self._cache_db.execute(
+                "SELECT qtype, content, ts FROM deepseek_cache WHERE key = ? AND ts >= ?",
+                (key, int(time.time()) - CACHE_TTL)
+            ).fetchone()
+        except sqlite3.Error:
+            # 数据库被其他进程锁定等情况下按未命中处理
+            return None
+        if row is None:
+            return None
+        self._cache[key] = tuple(row)
+        return row[0], row[1]
+
+    def _cache_put(self, key: str, query_type: str, content: str) -> None:
+        """写入内存缓存和持久化缓存"""
+        ts = int(time.time())
+        self._cache[key] = (query_type, content, ts)
+        if self._cache_db is None:
+            return
+        try:
+            self._cache_db.execute(
+                "INSERT OR REPLACE INTO deepseek_cache (key, qtype, content, ts) VALUES (?, ?, ?, ?)",
+                (key, query_type, content, ts)
+            )
+            self._cache_db.commit()
+        except sqlite3.Error:
+            pass
+
+    def _cache_drop(self, key: str) -> None:
+        """从内存缓存和持久化缓存中删除条目"""
+        self._cache.pop(key, None)
+        if self._cache_db is None:
+            return
+        try:
+            self._cache_db.execute("DELETE FROM deepseek_cache WHERE key = ?", (key,))
+            self._cache_db.commit()
+        except sqlite3.Error:
+            pass
+
+    def _new_client(self) -> httpx.AsyncClient:
+        """创建HTTP客户端"""
+        # 复用HTTP连接，避免每次查询重新进行DNS解析和TLS握手
+        # httpx会根据已安装的解码器自动设置Accept-Encoding（gzip、deflate，以及可选的br/zstd）
+        return httpx.AsyncClient(
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.deepseek_api_key}"
+            },
+            timeout=30,
+            transport=httpx.AsyncHTTPTransport(
+                http2=HTTP2_AVAILABLE,
+                retries=DEEPSEEK_RETRIES,
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=4)
+            )
+        )
+
+    @staticmethod
+    async def _own_client(client: httpx.AsyncClient) -> AsyncGenerator[None, None]:
+        """持有事件循环上的HTTP客户端，生成器关闭时关闭客户端"""
+        try:
+            yield
+        finally:
+            await client.aclose()
+
+    async def _http(self) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """返回当前事件循环使用的HTTP客户端和并发信号量
+        
+        每次asyncio.run()都会创建新的事件循环，旧循环上的连接和信号量不能再使用，
+        因此事件循环变化时重新创建；同一事件循环内的查询共用连接池。
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._client = self._new_client()
+            self._sem = asyncio.Semaphore(DEEPSEEK_CONCURRENCY)
+            # 事件循环会跟踪启动过的异步生成器，asyncio.run()和Runner结束前在该循环上将其关闭，
+            # 因此旧循环的连接池随循环一起关闭，不会遗留到垃圾回收时
+            self._client_owner = self._own_client(self._client)
+            await self._client_owner.asend(None)
+        return self._client, self._sem
+
+    async def aclose(self) -> None:
+        """关闭HTTP连接池和缓存数据库"""
+        if self._client_owner is not None and self._loop is asyncio.get_running_loop():
+            await self._client_owner.aclose()
+        self._loop = None
+        self._client = None
+        self._client_owner = None
+        if self._cache_db is not None:
+            self._cache_db.close()
+            self._cache_db = None
+
+    async def _stream_reply(self, data: Dict[str, Any],
+                            on_explain: Optional[Callable[[str], None]] = None
+                            ) -> Tuple[Optional[str], Optional[str]]:
+        """以流式方式请求DeepSeek，遇到限流或服务端错误时退避重试
+        
+        Args:
+            data: 请求体
+            on_explain: 确认是解释类回答后，每收到新内容就以当前的回答全文回调
+        
+        Returns:
+            Tuple[reply, finish_reason]: 模型回复的原始文本（未收到任何内容时为None）及结束原因
+        """
+        # 只序列化一次，重试时复用同一请求体
+        body = orjson.dumps(data)
+        client, sem = await self._http()
+        async with sem:
+            for attempt in range(DEEPSEEK_RETRIES + 1):
+                async with client.stream("POST", self.deepseek_api_url, content=body) as response:
+                    if response.status_code in DEEPSEEK_RETRY_STATUS and attempt < DEEPSEEK_RETRIES:
+                        await asyncio.sleep(0.3 * 2 ** attempt)
+                        continue
+                    response.raise_for_status()
+                    
+                    reply = ""
+                    finish_reason = None
+                    async for line in response.aiter_lines():
+                        # SSE格式：每个事件为 "data: {...}"，以 "data: [DONE]" 结束
+                        if not line.startswith("data: "):
+                            continue
+                        payload = line[6:]
+                        if payload == "[DONE]":
+                            break
+                        chunk = orjson.loads(payload)
+                        
+                        if self.debug_mode and chunk.get("usage"):
+                            hit_tokens = chunk["usage"].get("prompt_cache_hit_tokens", 0)
+                            console.print(f"[dim]提示词缓存命中: {hit_tokens} tokens[/dim]")
+                        if not chunk.get("choices"):
+                            continue
+                        choice = chunk["choices"][0]
+                        reply += choice["delta"].get("content") or ""
+                        finish_reason = choice.get("finish_reason") or finish_reason
+                        
+                        text = reply.lstrip()
+                        if text.startswith("EXPLAIN|"):
+                            if on_explain is not None:
+                                on_explain(text[8:].strip())
+                        elif text.startswith("CODE|") and "\n" in text[5:].strip():
+                            # 代码只有一行，收到换行后即可开始执行，不必等待剩余内容
+                            break
+                    return reply or None, finish_reason
+
+    @staticmethod
+    def _parse_reply(reply: str) -> Tuple[str, str]:
+        """解析模型回复，返回查询类型和内容"""
+        content = reply.strip()
+        if content.startswith("CODE|"):
+            return "code", content[5:].strip().split("\n", 1)[0].strip()
+        elif content.startswith("EXPLAIN|"):
+            return "explain", content[8:].strip()
+        else:
+            # 兼容旧格式
+            return "code", content
+
+    async def call_deepseek(self, prompt: str,
+                            on_explain: Optional[Callable[[str], None]] = None
+                            ) -> Tuple[Optional[str], Optional[str]]:
+        """调用DeepSeek API解析自然语言查询
+        
+        Args:
+            prompt: 用户的自然语言查询
+            on_explain: 流式接收解释类回答时的回调，参数为当前已收到的回答全文
+        
+        Returns:
+            Tuple[query_type, content]: 查询类型和内容
+            - query_type: "code" (数据查询) 或 "explain" (解释说明) 或 None
+            - content: 生成的代码或解释文本
+        """
+        key = self._cache_key(prompt)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        
+        # 相同的查询正在请求中时直接等待其结果，不重复调用API
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        
+        pending = asyncio.get_running_loop().create_future()
+        self._inflight[key] = pending
+        reply = (None, None)
+        try:
+            reply = await self._request_reply(key, prompt, on_explain)
+            return reply
+        finally:
+            del self._inflight[key]
+            pending.set_result(reply)
+
+    async def _request_reply(self, key: str, prompt: str,
+                             on_explain: Optional[Callable[[str], None]]
+                             ) -> Tuple[Optional[str], Optional[str]]:
+        """缓存未命中时查找语义缓存或请求API，并写入缓存"""
+        # 语义命中的回答不写入精确缓存，以免近似匹配的结果以当前查询的键保存
+        cached, vector = self._semantic_get(prompt)
+        if cached is not None:
+            return cached
+        
+        try:
             data = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.3
+                "model": DEEPSEEK_MODEL,
+                "messages": [SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+                "temperature": DEEPSEEK_TEMPERATURE,
+                "max_tokens": DEEPSEEK_MAX_TOKENS,
+                "stream": True,
+                "stream_options": {"include_usage": True}
             }
             
-            response = requests.post(
-                self.deepseek_api_url,
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            
-            response_json = response.json()
-            
-            if "choices" in response_json and len(response_json["choices"]) > 0:
-                content = response_json["choices"][0]["message"]["content"].strip()
-                
-                # 解析返回内容
-                if content.startswith("CODE|"):
-                    return "code", content[5:].strip()
-                elif content.startswith("EXPLAIN|"):
-                    return "explain", content[8:].strip()
-                else:
-                    # 兼容旧格式
-                    return "code", content
-            else:
+            reply, finish_reason = await self._stream_reply(data, on_explain)
+            if reply is None:
                 return None, None
+            
+            query_type, content = self._parse_reply(reply)
+            if finish_reason == "length":
+                # 达到max_tokens被截断的回答不完整，不写入缓存
+                if query_type == "explain":
+                    content += TRUNCATED_NOTE
+                return query_type, content
+            if content:
+                self._cache_put(key, query_type, content)
+                self._semantic_put(prompt, vector, query_type, content)
+            return query_type, content
                 
         except Exception as e:
             console.print(f"[red]✗[/red] API调用失败: {str(e)}")
             return None, None
 
     def execute_code(self, code: str) -> Any:
-        """执行生成的代码并返回结果"""
+        """执行生成的代码并返回结果，非实时的DataFrame结果按(代码, 日期)缓存"""
+        # 缓存键包含当天日期，跨日后自动重新获取
+        key = (code, datetime.date.today().isoformat())
+        cacheable = not _is_realtime(code)
+        
+        if cacheable:
+            with self._data_lock:
+                try:
+                    return self._data_cache[key]
+                except KeyError:
+                    pass
+        
         try:
-            local_vars = {"ak": ak, "pd": pd, "datetime": datetime}
-            exec(f"result = {code}", globals(), local_vars)
-            return local_vars.get("result")
+            namespace = {"__builtins__": SAFE_BUILTINS, "ak": ak, "pd": pd, "datetime": datetime}
+            result = eval(_compile_code(code), namespace)
         except Exception as e:
             return f"执行出错: {str(e)}"
+        
+        if cacheable and isinstance(result, pd.DataFrame):
+            with self._data_lock:
+                self._data_cache[key] = result
+        return result
 
     def format_dataframe(self, df: pd.DataFrame, max_rows: int = 10) -> Table:
         """将DataFrame转换为Rich Table格式"""
         # 限制显示行数
+        head_n = max_rows // 2
         if len(df) > max_rows:
-            df_display = pd.concat([df.head(max_rows//2), df.tail(max_rows//2)])
+            # 单次按位置取首尾行，避免head/tail/concat生成三个中间DataFrame
+            df_display = df.iloc[np.r_[:head_n, len(df) - head_n:len(df)]]
             show_ellipsis = True
         else:
             df_display = df
@@ -147,16 +746,21 @@ from rich import box)
         table = Table(box=box.ROUNDED, show_header=True, header_style="bold cyan")
         
         # 添加列
-        for col in df_display.columns:
-            table.add_column(str(col))
+        cols = [str(col) for col in df_display.columns]
+        for col in cols:
+            table.add_column(col)
         
-        # 添加行
-        for idx, row in df_display.iterrows():
-            table.add_row(*[str(val) for val in row])
-            
-            # 在中间插入省略号
-            if show_ellipsis and idx == df.head(max_rows//2).index[-1]:
-                table.add_row(*["..." for _ in df.columns], style="dim")
+        # 一次性将所有单元格转换为字符串，避免iterrows逐行构造Series
+        str_mat = df_display.astype(str).to_numpy()
+        
+        # 添加行：截断显示时按位置分为前后两段，中间插入省略号
+        split = head_n if show_ellipsis else len(str_mat)
+        for row in str_mat[:split]:
+            table.add_row(*row)
+        if show_ellipsis:
+            table.add_row(*["..."] * len(cols), style="dim")
+        for row in str_mat[split:]:
+            table.add_row(*row)
         
         return table
 
@@ -168,44 +772,136 @@ from rich import box)
         
         try:
             # 创建data文件夹（如果不存在）
-            data_folder = "data"
-            if not os.path.exists(data_folder):
-                os.makedirs(data_folder)
+            os.makedirs(self._data_dir, exist_ok=True)
+            
+            is_dataframe = isinstance(self.last_result, pd.DataFrame)
+            default_ext = ".parquet" if is_dataframe else ".txt"
             
             # 生成默认文件名：问题+时间戳
             if filename is None:
                 timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                # 清理问题中的特殊字符，保留中文和英文
-                clean_query = "".join(c if c.isalnum() or c in "._- 中文" else "" for c in self.last_query)
-                # 限制文件名长度
-                clean_query = clean_query[:30]
-                filename = f"{clean_query}_{timestamp}.csv"
+                # 清理问题中的特殊字符，保留中文和英文，并限制文件名长度
+                clean_query = FILENAME_STRIP.sub("", self.last_query)[:30]
+                filename = f"{clean_query}_{timestamp}{default_ext}"
             
-            # 确保文件名以.csv结尾
-            if not filename.endswith(".csv"):
-                filename += ".csv"
+            # 未指定支持的格式时使用默认格式（DataFrame可显式指定.csv或.feather）
+            ext = os.path.splitext(filename)[1].lower()
+            valid_ext = ext in DATAFRAME_FORMATS if is_dataframe else bool(ext)
+            if not valid_ext:
+                filename += default_ext
+                ext = default_ext
             
             # 完整文件路径
-            filepath = os.path.join(data_folder, filename)
+            filepath = os.path.join(self._data_dir, filename)
             
-            # 如果是DataFrame则保存为CSV
-            if isinstance(self.last_result, pd.DataFrame):
-                self.last_result.to_csv(filepath, index=False, encoding="utf-8-sig")
-                console.print(f"[green]✓ 数据已保存到: {os.path.abspath(filepath)}[/green]")
+            # DataFrame按扩展名选择格式保存
+            if is_dataframe:
+                if ext == ".csv":
+                    self.last_result.to_csv(filepath, index=False, encoding="utf-8-sig")
+                else:
+                    try:
+                        if ext == ".feather":
+                            self.last_result.reset_index(drop=True).to_feather(filepath)
+                        else:
+                            self.last_result.to_parquet(filepath, engine="pyarrow", compression="zstd", index=False)
+                    except (ImportError, ValueError, TypeError, NotImplementedError) as e:
+                        # 未安装pyarrow，或数据无法转换为Arrow格式（如混有"-"占位符的object列、非字符串列名）
+                        console.print(f"[yellow]⚠ 无法保存为{ext[1:]}格式（{str(e)}），改为保存为CSV[/yellow]")
+                        if os.path.exists(filepath):
+                            os.remove(filepath)
+                        filepath = os.path.splitext(filepath)[0] + ".csv"
+                        self.last_result.to_csv(filepath, index=False, encoding="utf-8-sig")
+                console.print(f"[green]✓ 数据已保存到: {filepath}[/green]")
             else:
                 # 其他类型的结果保存为文本
                 with open(filepath, "w", encoding="utf-8") as f:
                     f.write(str(self.last_result))
-                console.print(f"[green]✓ 数据已保存到: {os.path.abspath(filepath)}[/green]")
+                console.print(f"[green]✓ 数据已保存到: {filepath}[/green]")
         except Exception as e:
             console.print(f"[red]✗ 保存失败: {str(e)}[/red]")
 
-    def query(self, natural_language: str) -> None:
+    async def query(self, natural_language: str) -> None:
         """主函数：接收自然语言查询，返回数据结果"""
+        live = None
+        query_type, content = None, None
+        
+        def show_explain(text: str) -> None:
+            """边接收边显示解释类回答"""
+            nonlocal live
+            if live is None:
+                status.stop()
+                live = Live(self._explain_panel(text), console=console, refresh_per_second=8)
+                live.start()
+            else:
+                live.update(self._explain_panel(text))
+        
         # 显示处理状态
-        with console.status("[cyan]正在分析您的查询...", spinner="dots"):
-            query_type, content = self.call_deepseek(natural_language)
+        try:
+            with console.status("[cyan]正在分析您的查询...", spinner="dots") as status:
+                query_type, content = await self.call_deepseek(
+                    natural_language,
+                    on_explain=show_explain if console.is_terminal else None
+                )
+        finally:
+            if live is not None:
+                if query_type == "explain" and content:
+                    live.update(self._explain_panel(content))
+                live.stop()
+        
+        # 解释类回答已在接收过程中显示
+        if live is not None and query_type == "explain" and content:
+            self.last_result = None  # 解释不保存
+            return
         
+        result = None
+        if query_type == "code" and content:
+            if self.debug_mode:
+                console.print(f"[dim]生成的代码: {content}[/dim]")
+            
+            with console.status("[cyan]正在获取数据...", spinner="dots"):
+                result = await self._fetch_data(natural_language, content)
+        
+        self._show_result(natural_language, query_type, content, result)
+
+    async def _resolve(self, natural_language: str) -> Tuple[Optional[str], Optional[str], Any]:
+        """解析查询并在需要时获取数据（不输出任何内容）"""
+        query_type, content = await self.call_deepseek(natural_language)
+        result = None
+        if query_type == "code" and content:
+            result = await self._fetch_data(natural_language, content)
+        return query_type, content, result
+
+    async def _fetch_data(self, natural_language: str, code: str) -> Any:
+        """在线程中执行生成的代码；执行失败时删除该查询的回复缓存，下次重新请求API"""
+        result = await asyncio.to_thread(self.execute_code, code)
+        if isinstance(result, str) and result.startswith("执行出错"):
+            self._cache_drop(self._cache_key(natural_language))
+        return result
+
+    async def query_many(self, natural_languages: List[str]) -> None:
+        """并发执行多个查询，并按输入顺序依次显示结果"""
+        with console.status(f"[cyan]正在处理 {len(natural_languages)} 个查询...", spinner="dots"):
+            replies = await asyncio.gather(*[self._resolve(q) for q in natural_languages])
+        
+        for natural_language, (query_type, content, result) in zip(natural_languages, replies):
+            if self.debug_mode and query_type == "code" and content:
+                console.print(f"[dim]生成的代码: {content}[/dim]")
+            self._show_result(natural_language, query_type, content, result)
+            console.print()
+
+    @staticmethod
+    def _explain_panel(content: str) -> Panel:
+        """解释类回答的显示面板"""
+        return Panel(
+            Markdown(content),
+            title="[green]💡 回答",
+            border_style="green",
+            padding=(1, 2)
+        )
+
+    def _show_result(self, natural_language: str, query_type: Optional[str],
+                     content: Optional[str], result: Any) -> None:
+        """显示单个查询的回答或数据结果"""
         if not query_type or not content:
             console.print(Panel(
                 "[yellow]抱歉，无法理解您的查询，请尝试用其他方式表述",
@@ -216,22 +912,10 @@ from rich import box)
         
         # 处理解释类问题
         if query_type == "explain":
-            console.print(Panel(
-                Markdown(content),
-                title="[green]💡 回答",
-                border_style="green",
-                padding=(1, 2)
-            ))
+            console.print(self._explain_panel(content))
             self.last_result = None  # 解释不保存
             return
         
-        # 处理数据查询
-        if self.debug_mode:
-            console.print(f"[dim]生成的代码: {content}[/dim]")
-        
-        with console.status("[cyan]正在获取数据...", spinner="dots"):
-            result = self.execute_code(content)
-        
         # 保存查询结果和语句
         self.last_result = result
         self.last_query = natural_language
@@ -250,7 +934,7 @@ from rich import box)
                 title=f"[green]✓ 查询结果[/green] [dim]({len(result)} 条记录)[/dim]",
                 border_style="green"
             ))
-            console.print("[dim]输入 'save' 命令可保存此次查询结果[/dim]")
+            console.print(SAVE_HINT)
         else:
             console.print(Panel(
                 str(result),
@@ -259,70 +943,69 @@ from rich import box)
                 padding=(1, 2)
             ))
 
+def _quit_command(query_tool: NLDataQuery) -> bool:
+    """退出程序"""
+    console.print("\n[cyan]感谢使用，再见！[/cyan]")
+    return True
+
+def _debug_command(query_tool: NLDataQuery) -> bool:
+    """切换调试模式"""
+    query_tool.debug_mode = not query_tool.debug_mode
+    status = "开启" if query_tool.debug_mode else "关闭"
+    console.print(f"[yellow]调试模式已{status}[/yellow]\n")
+    return False
+
+def _save_command(query_tool: NLDataQuery) -> bool:
+    """保存最后一次的查询结果"""
+    query_tool.save_result()
+    console.print()
+    return False
+
+# 交互命令（不区分大小写），处理函数返回True时退出程序
+COMMANDS: Dict[str, Callable[[NLDataQuery], bool]] = {
+    "exit": _quit_command,
+    "quit": _quit_command,
+    "退出": _quit_command,
+    "debug": _debug_command,
+    "save": _save_command
+}
+
 def main():
     """主程序入口"""
     try:
         # 显示欢迎界面
-        console.print(Panel.fit(
-            "[bold cyan]金融数据智能查询助手[/bold cyan]\n"
-            "[dim]基于 AKShare 和 DeepSeek AI[/dim]",
-            border_style="cyan"
-        ))
-        
-        console.print("\n[bold]使用说明:[/bold]")
-        console.print("• 您可以用自然语言查询金融数据")
-        console.print("• 也可以提出问题寻求解释和建议")
-        console.print("• 输入 [yellow]'save'[/yellow] 保存最后一次的查询数据")
-        console.print("• 输入 [yellow]'exit'[/yellow] 或 [yellow]'quit'[/yellow] 退出程序")
-        console.print("• 输入 [yellow]'debug'[/yellow] 切换调试模式\n")
-        
-        console.print("[bold]示例查询:[/bold]")
-        examples = [
-            "获取上证指数最近10天的数据",
-            "查询贵州茅台的最新股价",
-            "什么是市盈率？",
-            "获取国内成品油价格调整信息"
-        ]
-        for i, example in enumerate(examples, 1):
-            console.print(f"  {i}. [cyan]{example}[/cyan]")
-        
-        console.print()
+        console.print(WELCOME)
         
         # 创建查询工具实例
         query_tool = NLDataQuery(debug_mode=False)
-        
-        while True:
-            try:
-                # 获取用户输入
-                user_input = console.input("[bold green]❯[/bold green] ").strip()
-                
-                if not user_input:
-                    continue
-                
-                if user_input.lower() in ["exit", "quit", "退出"]:
-                    console.print("\n[cyan]感谢使用，再见！[/cyan]")
+        # 整个会话共用一个事件循环，使HTTP连接池能够跨查询复用；
+        # 查询中按Ctrl+C时Runner会取消正在运行的查询，待其清理完毕后再抛出KeyboardInterrupt
+        with asyncio.Runner() as runner:
+            while True:
+                try:
+                    # 获取用户输入
+                    user_input = console.input("[bold green]❯[/bold green] ").strip()
+                    
+                    if not user_input:
+                        continue
+                    
+                    command = COMMANDS.get(user_input.lower())
+                    if command is not None:
+                        if command(query_tool):
+                            break
+                        continue
+                    
+                    # 执行查询
+                    runner.run(query_tool.query(user_input))
+                    console.print()  # 空行分隔
+                    
+                except KeyboardInterrupt:
+                    console.print("\n\n[cyan]感谢使用，再见！[/cyan]")
                     break
-                
-                if user_input.lower() == "debug":
-                    query_tool.debug_mode = not query_tool.debug_mode
-                    status = "开启" if query_tool.debug_mode else "关闭"
-                    console.print(f"[yellow]调试模式已{status}[/yellow]\n")
-                    continue
-                
-                if user_input.lower() == "save":
-                    query_tool.save_result()
-                    console.print()
-                    continue
-                
-                # 执行查询
-                query_tool.query(user_input)
-                console.print()  # 空行分隔
-                
-            except KeyboardInterrupt:
-                console.print("\n\n[cyan]感谢使用，再见！[/cyan]")
-                break
-            except Exception as e:
-                console.print(f"[red]✗ 出错: {str(e)}[/red]\n")
+                except Exception as e:
+                    console.print(f"[red]✗ 出错: {str(e)}[/red]\n")
+            
+            runner.run(query_tool.aclose())
     
     except Exception as e:
         console.print(f"[red]程序初始化失败: {str(e)}[/red]")
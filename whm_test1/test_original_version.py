@@ -0,0 +1,367 @@
+import asyncio
+import importlib.util
+import json
+import os
+
+import httpx
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), "original version.py")
+
+
+@pytest.fixture
+def nlq(tmp_path, monkeypatch):
+    """加载主程序模块，缓存数据库等文件写入临时目录"""
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "test-key")
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location("nlq", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def sse_response(content, finish_reason="stop"):
+    """构造DeepSeek流式响应"""
+    events = [
+        {"choices": [{"delta": {"content": content}, "finish_reason": None}]},
+        {"choices": [{"delta": {}, "finish_reason": finish_reason}]},
+    ]
+    body = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+    return httpx.Response(200, content=body.encode("utf-8"))
+
+
+def make_tool(nlq, replies, calls, finish_reason="stop"):
+    """创建查询工具，API请求由replies（提示词 -> 回复）应答，并记录到calls"""
+    async def handler(request):
+        prompt = json.loads(request.content)["messages"][1]["content"]
+        calls.append(prompt)
+        await asyncio.sleep(0.01)
+        return sse_response(replies[prompt], finish_reason)
+
+    tool = nlq.NLDataQuery()
+    tool._new_client = lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return tool
+
+
+def test_failed_code_reply_is_not_replayed_from_cache(nlq):
+    calls = []
+    tool = make_tool(nlq, {"坏代码": "CODE|len(1)"}, calls)
+
+    async def run():
+        await tool.query("坏代码")
+        await tool.query("坏代码")
+
+    asyncio.run(run())
+    assert calls == ["坏代码", "坏代码"]
+    assert tool._cache_get(tool._cache_key("坏代码")) is None
+
+
+def test_explain_reply_is_cached(nlq):
+    calls = []
+    tool = make_tool(nlq, {"什么是市盈率？": "EXPLAIN|股价除以每股收益"}, calls)
+
+    async def run():
+        return [await tool.call_deepseek("什么是市盈率？") for _ in range(2)]
+
+    assert asyncio.run(run()) == [("explain", "股价除以每股收益")] * 2
+    assert calls == ["什么是市盈率？"]
+    # 新实例从持久化缓存读取
+    assert nlq.NLDataQuery()._cache_get(tool._cache_key("什么是市盈率？")) == ("explain", "股价除以每股收益")
+
+
+def test_concurrent_identical_prompts_share_one_request(nlq):
+    calls = []
+    tool = make_tool(nlq, {"什么是市盈率？": "EXPLAIN|股价除以每股收益"}, calls)
+
+    async def run():
+        return await asyncio.gather(tool.call_deepseek("什么是市盈率？"),
+                                    tool.call_deepseek("什么是市盈率？"))
+
+    first, second = asyncio.run(run())
+    assert first == second == ("explain", "股价除以每股收益")
+    assert calls == ["什么是市盈率？"]
+    assert tool._inflight == {}
+
+
+def test_unusable_cache_db_is_treated_as_miss(nlq):
+    calls = []
+    tool = make_tool(nlq, {"什么是市盈率？": "EXPLAIN|股价除以每股收益"}, calls)
+    tool._cache_db.close()
+
+    assert tool._cache_get(tool._cache_key("什么是市盈率？")) is None
+    assert asyncio.run(tool.call_deepseek("什么是市盈率？")) == ("explain", "股价除以每股收益")
+    assert calls == ["什么是市盈率？"]
+
+
+def test_query_many_runs_in_separate_event_loops(nlq):
+    calls = []
+    # 查询数超过并发上限，请求需要在信号量上等待
+    prompts = [f"问题{i}" for i in range(10)]
+    tool = make_tool(nlq, {prompt: f"EXPLAIN|回答{prompt}" for prompt in prompts}, calls)
+
+    asyncio.run(tool.query_many(prompts[:5]))
+    asyncio.run(tool.query_many(prompts[5:]))
+    assert sorted(calls) == sorted(prompts)
+
+
+def test_clients_are_closed_with_their_event_loop(nlq):
+    calls = []
+    tool = make_tool(nlq, {"问题1": "EXPLAIN|回答1", "问题2": "EXPLAIN|回答2"}, calls)
+    clients = []
+    new_client = tool._new_client
+
+    def record_client():
+        clients.append(new_client())
+        return clients[-1]
+
+    tool._new_client = record_client
+    asyncio.run(tool.call_deepseek("问题1"))
+    assert clients[0].is_closed
+
+    async def run():
+        await tool.call_deepseek("问题2")
+        await tool.aclose()
+
+    asyncio.run(run())
+    assert len(clients) == 2 and clients[1].is_closed
+    # 关闭后缓存数据库不可用，查询退回到内存缓存
+    assert tool._cache_db is None
+    assert tool._cache_get(tool._cache_key("问题2")) == ("explain", "回答2")
+
+
+class ConstantEmbedder:
+    """所有文本都映射到同一个向量，模拟措辞相近的查询"""
+
+    def encode(self, texts, normalize_embeddings=True):
+        import numpy as np
+        return np.ones((len(texts), 4), dtype=np.float32) / 2
+
+
+def test_semantic_cache_only_serves_explain_replies(nlq):
+    faiss = pytest.importorskip("faiss")
+    calls = []
+    tool = make_tool(nlq, {
+        "上证指数最近10天": 'CODE|ak.stock_zh_index_daily(symbol="sh000001").tail(10)',
+        "上证指数最近30天": 'CODE|ak.stock_zh_index_daily(symbol="sh000001").tail(30)',
+        "什么是市盈率？": "EXPLAIN|股价除以每股收益",
+    }, calls)
+    tool._embed = ConstantEmbedder()
+    tool._index = faiss.IndexFlatIP(4)
+    tool._semantic_loaded = True
+
+    async def run():
+        return [await tool.call_deepseek(prompt)
+                for prompt in ("上证指数最近10天", "上证指数最近30天", "什么是市盈率？", "市盈率是什么意思")]
+
+    replies = asyncio.run(run())
+    assert replies[1] == ("code", 'ak.stock_zh_index_daily(symbol="sh000001").tail(30)')
+    assert replies[3] == ("explain", "股价除以每股收益")
+    assert calls == ["上证指数最近10天", "上证指数最近30天", "什么是市盈率？"]
+
+
+def test_semantic_cache_loads_on_first_lookup(nlq, monkeypatch):
+    loads = []
+
+    def init_semantic_cache(self):
+        loads.append(self)
+        self._semantic_loaded = True
+
+    monkeypatch.setattr(nlq, "SEMANTIC_CACHE_AVAILABLE", True)
+    monkeypatch.setattr(nlq.NLDataQuery, "_init_semantic_cache", init_semantic_cache)
+    tool = nlq.NLDataQuery()
+    assert loads == []
+    # 数据查询不会触发向量模型加载
+    tool._semantic_get("获取上证指数最近10天的数据")
+    assert loads == []
+    tool._semantic_get("什么是市盈率？")
+    tool._semantic_get("市盈率是什么意思")
+    assert len(loads) == 1
+
+
+def test_semantic_cache_is_skipped_for_data_queries(nlq):
+    faiss = pytest.importorskip("faiss")
+    calls = []
+    tool = make_tool(nlq, {
+        "什么是市盈率？": "EXPLAIN|股价除以每股收益",
+        "查询茅台市盈率": 'CODE|ak.stock_a_indicator_lg(symbol="600519").tail(1)',
+    }, calls)
+    tool._embed = ConstantEmbedder()
+    tool._index = faiss.IndexFlatIP(4)
+    tool._semantic_loaded = True
+
+    async def run():
+        return [await tool.call_deepseek(prompt)
+                for prompt in ("什么是市盈率？", "查询茅台市盈率", "市盈率是什么意思")]
+
+    replies = asyncio.run(run())
+    assert replies[1] == ("code", 'ak.stock_a_indicator_lg(symbol="600519").tail(1)')
+    assert replies[2] == ("explain", "股价除以每股收益")
+    assert calls == ["什么是市盈率？", "查询茅台市盈率"]
+    # 语义命中的回答不以新查询的键写入精确缓存
+    assert tool._cache_get(tool._cache_key("市盈率是什么意思")) is None
+
+
+@pytest.mark.parametrize("code", [
+    "pd.io.common.os.system('echo PWNED')",
+    "pd.io.common.os.getcwd()",
+    "pd.read_pickle('/tmp/x.pkl')",
+    "ak.os.system('echo PWNED')",
+    "ak.stock_zh_index_daily(symbol='sh000001').to_pickle('/tmp/x.pkl')",
+    "ak.stock_zh_index_daily(symbol='sh000001').apply('to_csv', args=('/tmp/x.csv',))",
+    "ak.stock_zh_index_daily(symbol='sh000001').query('close > 1')",
+    "ak.stock_zh_index_daily(symbol='sh000001').__class__",
+    "datetime.sys.modules",
+    "__import__('os').system('echo PWNED')",
+    "open('/etc/passwd').read()",
+    "[pd for pd in [1]]",
+    "(lambda ak: ak.os)(1)",
+    "pd.DataFrame({'a': [1]}).to_string('/tmp/pwn_to_string.txt')",
+    "pd.Series([1]).to_string(buf='/tmp/pwn_to_string.txt')",
+    "'{0.__class__.__mro__}'.format(pd.DataFrame())",
+    "'{x.__class__}'.format_map({'x': pd.DataFrame()})",
+    "str.format('{0.__class__}', pd.DataFrame())",
+])
+def test_execute_code_rejects_unsafe_code(nlq, code, capfd):
+    tool = nlq.NLDataQuery()
+    result = tool.execute_code(code)
+    assert isinstance(result, str) and result.startswith("执行出错")
+    assert "PWNED" not in capfd.readouterr().out
+
+
+@pytest.mark.parametrize("code", [
+    "ak.stock_zh_index_daily(symbol='sh000001').tail(10)",
+    "ak.stock_zh_a_hist(symbol='600519', start_date=(datetime.date.today()"
+    " - datetime.timedelta(days=30)).strftime('%Y%m%d'))",
+    "ak.stock_zh_index_daily(symbol='sh000001')['close'].apply(lambda x: round(x, 2)).to_list()",
+    "pd.concat([ak.stock_zh_index_daily(symbol=s).tail(1) for s in ['sh000001', 'sz399001']])",
+])
+def test_compile_code_accepts_ak_call_chains(nlq, code):
+    nlq._compile_code(code)
+
+
+@pytest.mark.parametrize("code, expected", [
+    ("list(zip([1], [2]))", [(1, 2)]),
+    ("list(enumerate(['a']))", [(0, "a")]),
+    ("list(map(str, reversed([1, 2])))", ["2", "1"]),
+    ("all([isinstance(1, int), any([True])])", True),
+    ("sorted(set([2, 1, 2]))", [1, 2]),
+    ("datetime.date.today() > datetime.date(2000, 1, 1)", True),
+])
+def test_execute_code_allows_plain_builtins(nlq, code, expected):
+    assert nlq.NLDataQuery().execute_code(code) == expected
+
+
+@pytest.mark.parametrize("filename", ["result", "result.feather"])
+def test_save_result_falls_back_to_csv(nlq, tmp_path, filename):
+    pd = pytest.importorskip("pandas")
+    tool = nlq.NLDataQuery()
+    # akshare常用"-"表示缺失值，混合类型的object列无法转换为Arrow格式
+    tool.last_result = pd.DataFrame({"x": ["-", 1.5, 2.0]})
+    tool.last_query = "测试"
+    tool.save_result(filename)
+    assert sorted(os.listdir(tmp_path / "data")) == ["result.csv"]
+
+
+def test_save_result_writes_parquet_by_default(nlq, tmp_path):
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    tool = nlq.NLDataQuery()
+    tool.last_result = pd.DataFrame({"close": [1.0, 2.0]})
+    tool.last_query = "测试"
+    tool.save_result("result")
+    assert pd.read_parquet(tmp_path / "data" / "result.parquet")["close"].tolist() == [1.0, 2.0]
+
+
+def test_truncated_reply_is_flagged_and_not_cached(nlq):
+    calls = []
+    tool = make_tool(nlq, {"详细介绍市盈率": "EXPLAIN|股价除以每股收益，"}, calls, finish_reason="length")
+
+    async def run():
+        return [await tool.call_deepseek("详细介绍市盈率") for _ in range(2)]
+
+    assert asyncio.run(run()) == [("explain", "股价除以每股收益，" + nlq.TRUNCATED_NOTE)] * 2
+    assert calls == ["详细介绍市盈率"] * 2
+    assert tool._cache_get(tool._cache_key("详细介绍市盈率")) is None
+
+
+class FakeAkshare:
+    """记录调用次数的akshare替身，每次调用返回新的DataFrame"""
+
+    def __init__(self, fail_times=0):
+        self.calls = []
+        self.fail_times = fail_times
+
+    def __getattr__(self, name):
+        import pandas as pd
+
+        def fetch(**kwargs):
+            self.calls.append(name)
+            if self.fail_times:
+                self.fail_times -= 1
+                raise ConnectionError("网络错误")
+            return pd.DataFrame({"close": [1.0, 2.0]})
+        return fetch
+
+
+def test_execute_code_reuses_cached_dataframe(nlq, monkeypatch):
+    fake = FakeAkshare()
+    monkeypatch.setattr(nlq, "ak", fake)
+    tool = nlq.NLDataQuery()
+    code = "ak.stock_zh_index_daily(symbol='sh000001')"
+
+    first = tool.execute_code(code)
+    assert tool.execute_code(code) is first
+    assert fake.calls == ["stock_zh_index_daily"]
+
+
+def test_execute_code_does_not_cache_realtime_data(nlq, monkeypatch):
+    fake = FakeAkshare()
+    monkeypatch.setattr(nlq, "ak", fake)
+    tool = nlq.NLDataQuery()
+
+    for code in ("ak.stock_zh_a_spot_em()", "ak.stock_individual_realtime(symbol='600519')"):
+        assert tool.execute_code(code) is not tool.execute_code(code)
+    assert fake.calls == ["stock_zh_a_spot_em"] * 2 + ["stock_individual_realtime"] * 2
+
+
+def test_execute_code_does_not_cache_errors(nlq, monkeypatch):
+    fake = FakeAkshare(fail_times=1)
+    monkeypatch.setattr(nlq, "ak", fake)
+    tool = nlq.NLDataQuery()
+    code = "ak.stock_zh_index_daily(symbol='sh000001')"
+
+    assert tool.execute_code(code) == "执行出错: 网络错误"
+    assert tool.execute_code(code)["close"].tolist() == [1.0, 2.0]
+    assert fake.calls == ["stock_zh_index_daily"] * 2
+
+
+def test_data_cache_entries_expire(nlq, monkeypatch):
+    fake = FakeAkshare()
+    monkeypatch.setattr(nlq, "ak", fake)
+    now = [0.0]
+    tool = nlq.NLDataQuery()
+    tool._data_cache = nlq.TLRUCache(maxsize=nlq.DATA_CACHE_SIZE, ttu=nlq._data_ttu, timer=lambda: now[0])
+    daily = "ak.stock_zh_index_daily(symbol='sh000001')"
+    other = "ak.macro_china_cpi()"
+
+    for code in (daily, other):
+        tool.execute_code(code)
+    now[0] = nlq.DATA_TTL_DEFAULT
+    for code in (daily, other):
+        tool.execute_code(code)
+    assert fake.calls == ["stock_zh_index_daily", "macro_china_cpi", "macro_china_cpi"]
+    now[0] = nlq.DATA_TTL_DAILY
+    tool.execute_code(daily)
+    assert fake.calls[-1] == "stock_zh_index_daily" and len(fake.calls) == 4
+
+
+@pytest.mark.parametrize("max_rows, expected", [
+    (4, ["0", "1", "...", "8", "9"]),
+    (1, ["..."]),
+])
+def test_format_dataframe_places_ellipsis_by_position(nlq, max_rows, expected):
+    pd = pytest.importorskip("pandas")
+    # 重复的索引不影响省略号的位置
+    df = pd.DataFrame({"x": range(10)}, index=[0] * 10)
+    table = nlq.NLDataQuery().format_dataframe(df, max_rows=max_rows)
+    assert list(table.columns[0].cells) == expected